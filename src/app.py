@@ -1,11 +1,12 @@
+import asyncio
 import os
 import signal
 from typing import Final
 
-from dotenv import load_dotenv
 from telegram import Update
 from telegram.constants import ParseMode
-from telegram.ext import Application, ApplicationBuilder, CommandHandler, ContextTypes, MessageHandler, CallbackQueryHandler, filters, JobQueue
+from telegram.error import RetryAfter
+from telegram.ext import Application, ApplicationBuilder, CommandHandler, ContextTypes, MessageHandler, CallbackQueryHandler, InlineQueryHandler, filters, JobQueue
 
 from .commands import (
 	cmd_pingollama,
@@ -18,16 +19,22 @@ from .commands import (
 	cmd_setmax,
 	cmd_system,
 	cmd_clearhistory,
+	cmd_contextmode,
+	cmd_reloadsettings,
 	cmd_cancel,
 	handle_text,
+	handle_document,
 )
-from .texts import START_TEXT, HELP_TEXT, BOT_SHUTTING_DOWN, BOT_STARTED
+from .texts import START_TEXT, HELP_TEXT, BOT_SHUTTING_DOWN, BOT_STARTED, REQUEST_RESTORED
 from .session import session_manager
+from .settings import get_settings, load_env_file, reload_settings
+from .dispatcher import ChatOrderedUpdateProcessor
+from .inline import handle_inline_query
 from .ollama_client import unload_model
 
 
 def load_env() -> None:
-	load_dotenv()
+	load_env_file()
 
 
 def get_bot_token() -> str:
@@ -55,7 +62,9 @@ async def cmd_help(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
 
 
 def build_application(token: str) -> Application:
-    app = ApplicationBuilder().token(token).build()
+    # Ordered within a chat, concurrent across chats (see dispatcher.py)
+    processor = ChatOrderedUpdateProcessor(get_settings().max_concurrent_chats)
+    app = ApplicationBuilder().token(token).concurrent_updates(processor).build()
     # Ensure JobQueue is available (avoid PTBUserWarning and enable inactivity timer)
     if getattr(app, "job_queue", None) is None:
         try:
@@ -68,25 +77,100 @@ def build_application(token: str) -> Application:
     return app
 
 
+# Broadcasts stay well below Telegram's ~30 messages/s limit
+NOTIFY_CONCURRENCY = 5
+
+
+async def _notify_users(app: Application, user_ids, text: str) -> None:
+	"""Send the same message to many users, a few at a time."""
+	semaphore = asyncio.Semaphore(NOTIFY_CONCURRENCY)
+
+	async def _send(user_id: int) -> None:
+		async with semaphore:
+			try:
+				try:
+					await app.bot.send_message(user_id, text)
+				except RetryAfter as e:
+					# flood control: wait as told and try once more
+					await asyncio.sleep(e.retry_after)
+					await app.bot.send_message(user_id, text)
+			except Exception as e:
+				print(f"Failed to notify user {user_id}: {e}")
+
+	await asyncio.gather(*(_send(user_id) for user_id in user_ids))
+
+
+_background_tasks: set = set()
+
+
+async def drain_and_stop(app: Application) -> None:
+	"""Stop admitting new generations, let in-flight ones finish, then stop polling."""
+	if session_manager.is_draining():
+		return
+	drain_timeout = get_settings().shutdown_drain_timeout_seconds
+	print(f"Draining in-flight requests (up to {drain_timeout}s)...")
+	await session_manager.start_drain()
+	if not await session_manager.wait_drained(drain_timeout):
+		cancelled = await session_manager.cancel_inflight()
+		print(f"Drain deadline reached, cancelled {cancelled} in-flight requests.")
+	app.stop_running()
+
+
+def signal_handler(app: Application) -> None:
+	"""SIGTERM/SIGINT: start draining instead of stopping immediately."""
+	task = asyncio.get_running_loop().create_task(drain_and_stop(app))
+	_background_tasks.add(task)
+	task.add_done_callback(_background_tasks.discard)
+
+
+def reload_handler() -> None:
+	"""SIGHUP: re-read settings without dropping sessions."""
+	ok, msg = reload_settings()
+	print(f"SIGHUP settings reload: {msg}")
+
+
+def install_signal_handlers(app: Application) -> bool:
+	"""Route stop signals to the drain phase and SIGHUP to a settings reload.
+
+	Returns False where the loop can't do it (Windows).
+	"""
+	loop = asyncio.get_running_loop()
+	try:
+		for sig in (signal.SIGINT, signal.SIGTERM):
+			loop.add_signal_handler(sig, signal_handler, app)
+		if hasattr(signal, "SIGHUP"):
+			loop.add_signal_handler(signal.SIGHUP, reload_handler)
+	except (NotImplementedError, RuntimeError):
+		return False
+	return True
+
+
 async def shutdown_handler(app: Application) -> None:
-	"""Unload all models on shutdown."""
+	"""Persist state, notify users and unload all models on shutdown."""
 	print("Shutting down, notifying users and unloading all models...")
 	
+	# Persist session settings and requests cut off by the drain deadline
+	await session_manager.save_state()
+	
 	# Notify all active users about shutdown
 	active_users = await session_manager.get_active_users()
 	if active_users:
 		print(f"Notifying {len(active_users)} active users about shutdown...")
-		for user_id in active_users:
-			try:
-				await app.bot.send_message(user_id, BOT_SHUTTING_DOWN)
-			except Exception as e:
-				print(f"Failed to notify user {user_id}: {e}")
+		await _notify_users(app, active_users, BOT_SHUTTING_DOWN)
 	
-	# Unload all models
+	# Unload all models concurrently under a single deadline
 	loaded_models = await session_manager.get_loaded_models()
-	for model_id in loaded_models:
-		print(f"Unloading model: {model_id}")
-		unload_model(model_id)
+	if loaded_models:
+		print(f"Unloading models: {', '.join(sorted(loaded_models))}")
+		unload_timeout = get_settings().shutdown_unload_timeout_seconds
+		unloads = asyncio.gather(
+			*(asyncio.to_thread(unload_model, model_id, timeout=unload_timeout) for model_id in loaded_models),
+			return_exceptions=True,
+		)
+		try:
+			await asyncio.wait_for(unloads, timeout=unload_timeout + 1)
+		except asyncio.TimeoutError:
+			print("Model unload deadline reached, continuing shutdown.")
 	await session_manager.unload_all_models()
 	print("All models unloaded.")
 
@@ -96,19 +180,30 @@ async def startup_notify(app: Application) -> None:
 	active_users = await session_manager.get_active_users()
 	if active_users:
 		print(f"Notifying {len(active_users)} active users about startup...")
-		for user_id in active_users:
-			try:
-				await app.bot.send_message(user_id, BOT_STARTED)
-			except Exception as e:
-				print(f"Failed to notify user {user_id}: {e}")
+		await _notify_users(app, active_users, BOT_STARTED)
+	for item in session_manager.pop_interrupted():
+		try:
+			await app.bot.send_message(item["chat_id"], REQUEST_RESTORED.format(text=item["text"][:get_settings().max_telegram_chunk - 100]))
+		except Exception as e:
+			print(f"Failed to restore request for user {item.get('user_id')}: {e}")
+
+
+async def post_init(app: Application) -> None:
+	"""Set up the graceful-shutdown signal handlers, then greet users."""
+	if not install_signal_handlers(app):
+		print("[WARN] Signal handlers are not supported here; shutdown will not drain in-flight requests.")
+	await startup_notify(app)
 
 
 def main() -> None:
 	token = get_bot_token()
+	ok, msg = reload_settings()
+	if not ok:
+		raise RuntimeError(msg)
 	app = build_application(token)
 
 	# Register lifecycle callbacks
-	app.post_init = startup_notify
+	app.post_init = post_init
 	app.post_shutdown = shutdown_handler
 
 	app.add_handler(CommandHandler("start", cmd_start))
@@ -119,15 +214,20 @@ def main() -> None:
 	app.add_handler(CommandHandler("system", cmd_system))
 	app.add_handler(CommandHandler("end", cmd_end))
 	app.add_handler(CommandHandler("clearhistory", cmd_clearhistory))
+	app.add_handler(CommandHandler("contextmode", cmd_contextmode))
 	app.add_handler(CommandHandler("cancel", cmd_cancel))
 	app.add_handler(CommandHandler("settemp", cmd_settemp))
 	app.add_handler(CommandHandler("settopp", cmd_settopp))
 	app.add_handler(CommandHandler("setmax", cmd_setmax))
 	app.add_handler(CommandHandler("pingollama", cmd_pingollama))
+	app.add_handler(CommandHandler("reloadsettings", cmd_reloadsettings))
 	app.add_handler(MessageHandler(filters.TEXT & (~filters.COMMAND), handle_text))
+	app.add_handler(MessageHandler(filters.Document.ALL, handle_document))
+	app.add_handler(InlineQueryHandler(handle_inline_query))
 
 	print("Bot is starting... Press Ctrl+C to stop.")
-	app.run_polling()
+	# Stop signals are handled by signal_handler() so shutdown can drain first
+	app.run_polling(stop_signals=None)
 
 
 if __name__ == "__main__":
@@ -1,9 +1,17 @@
+import asyncio
+import os
+import threading
+import time
+from typing import Optional
+
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import ContextTypes
 
-from .ollama_client import ping_ollama, list_ollama_models, chat_with_model, stream_chat_with_model, warm_up_model, unload_model, stop_model_cli
+from .ollama_client import ping_ollama, list_ollama_models, chat_with_model, generate_with_context, stream_chat_with_model, warm_up_model, unload_model, stop_model_cli
 from .session import session_manager
-from .constants import MAX_TELEGRAM_CHUNK, MAX_HISTORY_MESSAGES, INACTIVITY_TIMEOUT_SECONDS
+from .routing import model_router
+from .documents import DocumentJob, get_upload_dir, remove_upload
+from .settings import get_settings, reload_settings
 from . import texts
 
 
@@ -21,14 +29,25 @@ async def _on_inactivity(context: ContextTypes.DEFAULT_TYPE) -> None:
 	sess = await session_manager.get_status(user_id)
 	if sess.model_id:
 		# Unload model on timeout
-		unload_model(sess.model_id)
+		await asyncio.to_thread(unload_model, sess.model_id)
+	await _unload_fallbacks(user_id)
 	model_id = await session_manager.end_session(user_id)
 	try:
-		await context.bot.send_message(chat_id, texts.INACTIVITY_ENDED)
+		minutes = max(1, round(get_settings().inactivity_timeout_seconds / 60))
+		await context.bot.send_message(chat_id, texts.INACTIVITY_ENDED.format(minutes=minutes))
 	except Exception:
 		pass
 
 
+async def _unload_fallbacks(user_id: int) -> None:
+	"""Unload the lighter models the router used for the user's requests."""
+	models = await session_manager.get_fallback_models(user_id)
+	results = await asyncio.gather(*(asyncio.to_thread(unload_model, model) for model in models))
+	for model, res in zip(models, results):
+		if not res.get("ok"):
+			print(f"Failed to unload fallback model {model}: {res.get('error')}")
+
+
 def _job_name(user_id: int) -> str:
 	return f"inactivity-{user_id}"
 
@@ -45,7 +64,7 @@ async def _reset_inactivity_timer(update: Update, context: ContextTypes.DEFAULT_
 		j.schedule_removal()
 	jq.run_once(
 		_on_inactivity,
-		when=INACTIVITY_TIMEOUT_SECONDS,
+		when=get_settings().inactivity_timeout_seconds,
 		data={"user_id": user_id, "chat_id": chat_id},
 		name=_job_name(user_id),
 	)
@@ -62,7 +81,7 @@ async def _cancel_inactivity_timer(context: ContextTypes.DEFAULT_TYPE, user_id:
 async def cmd_pingollama(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
 	# Add user to active users
 	await session_manager.add_active_user(update.effective_user.id)
-	info = ping_ollama()
+	info = await asyncio.to_thread(ping_ollama)
 	msg = texts.OLLAMA_DOWN if info is None else f"Оllama доступна: {info}"
 	if update.message:
 		await update.message.reply_text(msg)
@@ -80,7 +99,7 @@ async def cmd_omodels(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
 			await update.message.reply_text(busy_text)
 		return
 	
-	ids = list_ollama_models()
+	ids = await asyncio.to_thread(list_ollama_models)
 	if not ids:
 		if update.message:
 			await update.message.reply_text("Ollama не вернула список моделей. Убедитесь, что сервис запущен и модели установлены.")
@@ -118,7 +137,7 @@ async def cb_select_model(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
 	if ok:
 		await _reset_inactivity_timer(update, context)
 		await query.message.reply_text("Загружаю модель в память...")
-		result = warm_up_model(model_id)
+		result = await asyncio.to_thread(warm_up_model, model_id)
 		if result.get("ok"):
 			await query.message.reply_text("Модель готова к работе.")
 		else:
@@ -140,6 +159,7 @@ async def cmd_status(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None
 		lines.append(f"🤖 Бот занят пользователем: {locked_by}")
 	lines.append(f"temperature={sess.temperature}, top_p={sess.top_p}, max_tokens={sess.max_tokens}")
 	lines.append(texts.STATUS_SYSTEM_SET if sess.system_prompt else texts.STATUS_SYSTEM_NOT_SET)
+	lines.append(f"context_mode: {'вкл' if sess.context_mode else 'выкл'}")
 	await update.message.reply_text("\n".join(lines))
 	if sess.model_id:
 		await _reset_inactivity_timer(update, context)
@@ -155,16 +175,17 @@ async def cmd_end(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
 	sess = await session_manager.get_status(update.effective_user.id)
 	if sess.model_id:
 		await update.message.reply_text("Выгружаю модель из памяти...")
-		res = unload_model(sess.model_id)
+		res = await asyncio.to_thread(unload_model, sess.model_id)
 		if not res.get("ok"):
 			# Fallback to CLI stop
-			cli = stop_model_cli(sess.model_id)
+			cli = await asyncio.to_thread(stop_model_cli, sess.model_id)
 			if cli.get("ok"):
 				await update.message.reply_text("Модель выгружена (CLI).")
 			else:
 				await update.message.reply_text(f"Не удалось выгрузить модель: {res.get('error') or cli.get('error')}")
 		else:
 			await update.message.reply_text("Модель выгружена.")
+	await _unload_fallbacks(update.effective_user.id)
 	model_id = await session_manager.end_session(update.effective_user.id)
 	await _cancel_inactivity_timer(context, update.effective_user.id)
 	await update.message.reply_text("Сессия завершена. Модель и настройки сброшены.")
@@ -177,8 +198,9 @@ async def cmd_clearhistory(update: Update, context: ContextTypes.DEFAULT_TYPE) -
 	# Add user to active users
 	await session_manager.add_active_user(update.effective_user.id)
 	
+	# also drops the stored Ollama context, which still holds the old dialogue
+	await session_manager.clear_history(update.effective_user.id)
 	sess = await session_manager.get_status(update.effective_user.id)
-	sess.history.clear()
 	await update.message.reply_text("История диалога очищена (модель не перезапускалась).")
 	if sess.model_id:
 		await _reset_inactivity_timer(update, context)
@@ -192,7 +214,34 @@ async def cmd_cancel(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None
 	await session_manager.add_active_user(update.effective_user.id)
 	
 	await session_manager.set_pending(update.effective_user.id, None)
-	await update.message.reply_text("Ожидание ввода отменено.")
+	await update.message.reply_text(texts.PENDING_CANCELLED)
+
+
+async def cmd_contextmode(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+	if not update.message:
+		return
+	
+	# Add user to active users
+	await session_manager.add_active_user(update.effective_user.id)
+	
+	enabled = await session_manager.toggle_context_mode(update.effective_user.id)
+	sess = await session_manager.get_status(update.effective_user.id)
+	await update.message.reply_text(texts.CONTEXT_MODE_ON if enabled else texts.CONTEXT_MODE_OFF)
+	if sess.model_id:
+		await _reset_inactivity_timer(update, context)
+
+
+async def cmd_reloadsettings(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+	if not update.message:
+		return
+	
+	if update.effective_user.id not in get_settings().admin_user_ids:
+		await update.message.reply_text(texts.ADMIN_ONLY)
+		return
+	
+	ok, msg = reload_settings()
+	print(f"Settings reload by {update.effective_user.id}: {msg}")
+	await update.message.reply_text(msg)
 
 
 async def cmd_settemp(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -243,11 +292,181 @@ async def cmd_system(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None
 	await _reset_inactivity_timer(update, context)
 
 
-def _chunk_text(text: str, size: int = MAX_TELEGRAM_CHUNK):
+def _chunk_text(text: str, size: Optional[int] = None):
+	if size is None:
+		size = get_settings().max_telegram_chunk
 	for i in range(0, len(text), size):
 		yield text[i:i+size]
 
 
+# Document types that are plain text even though they are not text/*
+_TEXT_MIME_TYPES = {"application/json", "application/xml", "application/x-yaml", "application/x-ndjson", "application/csv"}
+
+
+def _context_key(sess, model: str) -> tuple:
+	return (model, sess.system_prompt, sess.temperature, sess.top_p, sess.max_tokens)
+
+
+def _build_replay_prompt(history: list, text: str) -> str:
+	"""Fold prior turns into a single prompt to seed a fresh /api/generate context."""
+	if not history:
+		return text
+	lines = ["Предыдущий диалог:"]
+	for role, content in history:
+		lines.append(f"{'Пользователь' if role == 'user' else 'Ассистент'}: {content}")
+	lines.append("")
+	lines.append(f"Пользователь: {text}")
+	return "\n".join(lines)
+
+
+def _generate_incremental(sess, text: str, model: str, cancel_event: threading.Event) -> dict:
+	"""Send only the new message when the stored context matches the current settings.
+
+	If the model (including a fallback picked by the router), system prompt or
+	generation settings changed since the context was built, there is none yet or
+	it grew past `context_max_tokens`, the last messages of the history are replayed
+	once to rebuild it. `sess` is a snapshot; the caller stores the returned context.
+	"""
+	settings = get_settings()
+	key = _context_key(sess, model)
+	if (
+		sess.context_tokens
+		and sess.context_key == key
+		and len(sess.context_tokens) <= settings.context_max_tokens
+	):
+		prompt = text
+		ctx = sess.context_tokens
+	else:
+		prompt = _build_replay_prompt(sess.history[-(settings.max_history_messages - 1):], text)
+		ctx = None
+	resp = generate_with_context(
+		model,
+		prompt,
+		# the system prompt is already encoded in an existing context
+		system=sess.system_prompt if ctx is None else "",
+		context=ctx,
+		temperature=sess.temperature,
+		top_p=sess.top_p,
+		num_predict=sess.max_tokens,
+		cancel_event=cancel_event,
+	)
+	resp["context_key"] = key
+	return resp
+
+
+async def _remember_turn(sess, user_text: str, answer: str) -> None:
+	await session_manager.append_turn(
+		sess.user_id, user_text, answer, get_settings().max_history_messages, sess.history_epoch
+	)
+
+
+async def _process_document(update: Update, context: ContextTypes.DEFAULT_TYPE, sess, path: str, task: str, label: str) -> None:
+	"""Map-reduce a text file on disk with the session model and reply with the combined answer."""
+	user_id = update.effective_user.id
+	cancel_event = threading.Event()
+	request = await session_manager.begin_request(user_id, update.message.chat_id, label, cancel_event)
+	if request is None:
+		await update.message.reply_text(texts.BOT_DRAINING)
+		return
+
+	try:
+		status = await update.message.reply_text(texts.DOC_STARTED)
+		last_edit = 0.0
+
+		async def on_progress(done: int, total: int) -> None:
+			nonlocal last_edit
+			# Telegram rate-limits edits, so report at most every couple of seconds
+			now = time.monotonic()
+			if done < total and now - last_edit < 2.0:
+				return
+			last_edit = now
+			try:
+				await status.edit_text(texts.DOC_PROGRESS.format(done=done, total=total))
+			except Exception:
+				pass
+
+		# Route once per document so all chunks are answered by the same model
+		model = model_router.choose(sess.model_id)
+		await session_manager.note_served_model(user_id, model)
+		job = DocumentJob(
+			model,
+			task=task,
+			system_prompt=sess.system_prompt,
+			temperature=sess.temperature,
+			top_p=sess.top_p,
+			max_tokens=sess.max_tokens,
+			cancel_event=cancel_event,
+		)
+		resp = await job.run(path, on_progress)
+	except asyncio.CancelledError:
+		# Drain deadline passed; completed chunks stay cached for the retry
+		try:
+			await update.message.reply_text(texts.REQUEST_INTERRUPTED)
+		except Exception:
+			pass
+		return
+	except Exception:
+		await session_manager.end_request(request)
+		raise
+	finally:
+		remove_upload(path)
+	await session_manager.end_request(request)
+	if not resp.get("ok"):
+		await update.message.reply_text(texts.DOC_FAILED.format(error=resp.get("error")))
+		return
+
+	answer = resp.get("text") or ""
+	await _remember_turn(sess, f"{label}\n{job.task}", answer)
+	if model != sess.model_id:
+		answer += texts.ROUTED_NOTE.format(model=model)
+	for chunk in _chunk_text(answer):
+		await update.message.reply_text(chunk)
+	await _reset_inactivity_timer(update, context)
+
+
+async def handle_document(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+	if not update.message or not update.message.document:
+		return
+	
+	# Add user to active users
+	await session_manager.add_active_user(update.effective_user.id)
+	
+	doc = update.message.document
+	sess = await session_manager.get_status(update.effective_user.id)
+	locked_by = await session_manager.get_busy_info()
+	if locked_by is not None and locked_by != update.effective_user.id:
+		await update.message.reply_text(f"🤖 Бот занят пользователем {locked_by}. Попробуйте позже.")
+		return
+	
+	if not sess.model_id:
+		await update.message.reply_text(texts.NEED_SELECT_MODEL)
+		return
+
+	mime = doc.mime_type or ""
+	if mime and not (mime.startswith("text/") or mime in _TEXT_MIME_TYPES):
+		await update.message.reply_text(texts.DOC_NOT_TEXT)
+		return
+	max_bytes = get_settings().doc_max_bytes
+	if doc.file_size and doc.file_size > max_bytes:
+		await update.message.reply_text(texts.DOC_TOO_LARGE.format(mb=max_bytes // (1024 * 1024)))
+		return
+
+	upload_dir = await asyncio.to_thread(get_upload_dir)
+	path = os.path.join(upload_dir, f"{update.effective_user.id}-{doc.file_unique_id}")
+	try:
+		tg_file = await doc.get_file()
+		await tg_file.download_to_drive(path)
+	except Exception as e:
+		# the download URL embeds the bot token, so the error is only logged
+		print(f"Failed to download document for user {update.effective_user.id}: {e}")
+		await asyncio.to_thread(remove_upload, path)
+		await update.message.reply_text(texts.DOC_DOWNLOAD_FAILED)
+		return
+
+	task = (update.message.caption or "").strip()
+	await _process_document(update, context, sess, path, task, f"[документ: {doc.file_name or doc.file_unique_id}]")
+
+
 async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
 	if not update.message:
 		return
@@ -266,8 +485,9 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
 			except ValueError:
 				await update.message.reply_text(texts.ERR_TEMP)
 				return
-			sess.temperature = val
-			await session_manager.set_pending(update.effective_user.id, None)
+			if not await session_manager.set_param(update.effective_user.id, "temperature", val, if_pending="settemp"):
+				await update.message.reply_text(texts.PENDING_CANCELLED)
+				return
 			await update.message.reply_text(f"temperature = {val}")
 			await _reset_inactivity_timer(update, context)
 			return
@@ -279,8 +499,9 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
 			except ValueError:
 				await update.message.reply_text(texts.ERR_TOPP)
 				return
-			sess.top_p = val
-			await session_manager.set_pending(update.effective_user.id, None)
+			if not await session_manager.set_param(update.effective_user.id, "top_p", val, if_pending="settopp"):
+				await update.message.reply_text(texts.PENDING_CANCELLED)
+				return
 			await update.message.reply_text(f"top_p = {val}")
 			await _reset_inactivity_timer(update, context)
 			return
@@ -292,14 +513,16 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
 			except ValueError:
 				await update.message.reply_text(texts.ERR_MAX)
 				return
-			sess.max_tokens = val
-			await session_manager.set_pending(update.effective_user.id, None)
+			if not await session_manager.set_param(update.effective_user.id, "max_tokens", val, if_pending="setmax"):
+				await update.message.reply_text(texts.PENDING_CANCELLED)
+				return
 			await update.message.reply_text(f"max_tokens = {val}")
 			await _reset_inactivity_timer(update, context)
 			return
 		if sess.pending_action == "system":
-			sess.system_prompt = text
-			await session_manager.set_pending(update.effective_user.id, None)
+			if not await session_manager.set_param(update.effective_user.id, "system_prompt", text, if_pending="system"):
+				await update.message.reply_text(texts.PENDING_CANCELLED)
+				return
 			await update.message.reply_text("Системный промпт задан.")
 			await _reset_inactivity_timer(update, context)
 			return
@@ -314,31 +537,69 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
 		await update.message.reply_text(texts.NEED_SELECT_MODEL)
 		return
 
-	messages = []
-	if sess.system_prompt:
-		messages.append({"role": "system", "content": sess.system_prompt})
-	for role, content in sess.history[-(MAX_HISTORY_MESSAGES - 1):]:
-		messages.append({"role": role, "content": content})
-	messages.append({"role": "user", "content": text})
+	# Refuse new generations once shutdown has started draining
+	cancel_event = threading.Event()
+	request = await session_manager.begin_request(update.effective_user.id, update.message.chat_id, text, cancel_event)
+	if request is None:
+		await update.message.reply_text(texts.BOT_DRAINING)
+		return
 
-	await update.message.chat.send_action("typing")
-	resp = chat_with_model(
-		sess.model_id,
-		messages,
-		temperature=sess.temperature,
-		top_p=sess.top_p,
-		num_predict=sess.max_tokens,
-	)
+	# Under load the request may be served by a lighter fallback; sess.model_id stays as chosen
+	model = model_router.choose(sess.model_id)
+	await session_manager.note_served_model(update.effective_user.id, model)
+	try:
+		await update.message.chat.send_action("typing")
+		# Run the blocking HTTP call off the event loop so shutdown can drain/cancel it
+		with model_router.track(model):
+			if sess.context_mode:
+				resp = await asyncio.to_thread(_generate_incremental, sess, text, model, cancel_event)
+			else:
+				max_history = get_settings().max_history_messages
+				messages = []
+				if sess.system_prompt:
+					messages.append({"role": "system", "content": sess.system_prompt})
+				for role, content in sess.history[-(max_history - 1):]:
+					messages.append({"role": role, "content": content})
+				messages.append({"role": "user", "content": text})
+				resp = await asyncio.to_thread(
+					chat_with_model,
+					model,
+					messages,
+					temperature=sess.temperature,
+					top_p=sess.top_p,
+					num_predict=sess.max_tokens,
+					cancel_event=cancel_event,
+				)
+	except asyncio.CancelledError:
+		# Drain deadline passed: the request stays registered and is saved as interrupted
+		try:
+			await update.message.reply_text(texts.REQUEST_INTERRUPTED)
+		except Exception:
+			pass
+		return
+	except Exception:
+		await session_manager.end_request(request)
+		raise
+	await session_manager.end_request(request)
+	model_router.observe(model, resp.get("stats"))
+	if sess.context_mode:
+		# a failed turn drops the context so the next one replays the history
+		ok = resp.get("ok")
+		await session_manager.set_context(
+			sess.user_id,
+			resp.get("context") if ok else None,
+			resp.get("context_key") if ok else None,
+			sess.history_epoch,
+		)
 	if not resp.get("ok"):
 		await update.message.reply_text(f"Ошибка запроса к модели: {resp.get('error')}")
 		return
 
 	answer = resp.get("text") or ""
-	sess.history.append(("user", text))
-	sess.history.append(("assistant", answer))
-	if len(sess.history) > MAX_HISTORY_MESSAGES:
-		sess.history = sess.history[-MAX_HISTORY_MESSAGES:]
+	await _remember_turn(sess, text, answer)
 
+	if model != sess.model_id:
+		answer += texts.ROUTED_NOTE.format(model=model)
 	for chunk in _chunk_text(answer):
 		await update.message.reply_text(chunk)
 	await _reset_inactivity_timer(update, context)
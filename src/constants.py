@@ -6,5 +6,52 @@ MAX_TELEGRAM_CHUNK = 3800
 # Maximum number of messages to keep in in-memory history per user
 MAX_HISTORY_MESSAGES = 20
 
+# Incremental context mode: once Ollama's context array grows past this many
+# tokens it is dropped and rebuilt from the last MAX_HISTORY_MESSAGES messages
+CONTEXT_MAX_TOKENS = 8192
+
 # Auto-end session after this many seconds of inactivity
 INACTIVITY_TIMEOUT_SECONDS = 300
+
+# Graceful shutdown: how long in-flight generations may finish after SIGTERM
+SHUTDOWN_DRAIN_TIMEOUT_SECONDS = 20
+
+# Graceful shutdown: deadline for unloading all models (done concurrently)
+SHUTDOWN_UNLOAD_TIMEOUT_SECONDS = 10
+
+# Map-reduce over long documents: max characters per chunk sent to the model
+DOC_CHUNK_CHARS = 6000
+
+# Map-reduce over long documents: how many chunks are processed in parallel
+DOC_MAP_CONCURRENCY = 2
+
+# Telegram Bot API only lets bots download files up to 20 MB
+DOC_MAX_BYTES = 20 * 1024 * 1024
+
+# Cached per-chunk results older than this are removed
+DOC_CACHE_TTL_SECONDS = 24 * 60 * 60
+
+# Updates of different chats processed in parallel (same chat is always sequential)
+MAX_CONCURRENT_CHATS = 8
+
+# Inline mode: wait this long after the last keystroke before generating
+INLINE_DEBOUNCE_SECONDS = 0.8
+
+# Inline mode: answers are cached locally and by Telegram (cache_time) for this long
+INLINE_CACHE_TTL_SECONDS = 60
+
+# Inline mode: Telegram expires inline queries quickly, so answer within this time
+INLINE_ANSWER_TIMEOUT_SECONDS = 8
+
+# Inline mode: cap on generated tokens to keep answers fast
+INLINE_MAX_TOKENS = 256
+
+# Load-adaptive routing: reroute to a fallback model when the requested one has
+# this many requests in flight, is slower than this (tokens/s) or takes longer
+# than this to produce the first token (s). 0 disables a signal.
+ROUTE_MAX_QUEUE_DEPTH = 2
+ROUTE_MIN_TOKENS_PER_SEC = 5.0
+ROUTE_MAX_TTFT_SECONDS = 15.0
+
+# Load-adaptive routing: ignore measurements older than this so a degraded model gets retried
+ROUTE_STATS_TTL_SECONDS = 120
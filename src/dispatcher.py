@@ -0,0 +1,86 @@
+import asyncio
+from typing import Any, Awaitable, Dict, Hashable, Optional
+
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+# Commands that must stay responsive while the chat is busy with a generation
+BYPASS_COMMANDS = frozenset({"cancel", "status"})
+
+# Upper bound on updates admitted at once (running + waiting for their chat)
+MAX_QUEUED_UPDATES = 1024
+
+
+class ChatOrderedUpdateProcessor(BaseUpdateProcessor):
+	"""Process updates of one chat strictly in order, different chats in parallel.
+
+	Every update first takes its chat's lock (asyncio locks are FIFO, so arrival
+	order is kept), then a slot in the global worker semaphore. Updates waiting
+	behind a busy chat therefore don't occupy worker slots. Bypass commands skip
+	the chat lock so e.g. /cancel answers while a generation is running, but only
+	when nothing else of the chat is waiting: otherwise a /cancel could overtake
+	an earlier /settemp and leave its prompt pending.
+	"""
+
+	def __init__(self, max_concurrent_chats: int) -> None:
+		super().__init__(max_concurrent_updates=MAX_QUEUED_UPDATES)
+		self._workers = asyncio.Semaphore(max_concurrent_chats)
+		self._chat_locks: Dict[Hashable, asyncio.Lock] = {}
+		self._chat_refs: Dict[Hashable, int] = {}
+
+	@staticmethod
+	def _chat_key(update: object) -> Optional[Hashable]:
+		if not isinstance(update, Update):
+			return None
+		if update.inline_query:
+			# inline queries debounce/cancel each other themselves (see inline.py)
+			return None
+		if update.effective_chat:
+			return update.effective_chat.id
+		if update.effective_user:
+			# chosen inline results and the like have no chat
+			return ("user", update.effective_user.id)
+		return None
+
+	@staticmethod
+	def _is_bypass(update: object) -> bool:
+		if not isinstance(update, Update) or not update.message or not update.message.text:
+			return False
+		text = update.message.text
+		if not text.startswith("/"):
+			return False
+		command = text[1:].split(maxsplit=1)[0].split("@", 1)[0].lower()
+		return command in BYPASS_COMMANDS
+
+	def _has_waiting(self, key: Hashable) -> bool:
+		"""Whether updates of the chat are queued behind the one currently running."""
+		refs = self._chat_refs.get(key, 0)
+		lock = self._chat_locks.get(key)
+		running = 1 if lock is not None and lock.locked() else 0
+		return refs > running
+
+	async def do_process_update(self, update: object, coroutine: Awaitable[Any]) -> None:
+		key = self._chat_key(update)
+		if key is None or (self._is_bypass(update) and not self._has_waiting(key)):
+			await coroutine
+			return
+		lock = self._chat_locks.get(key)
+		if lock is None:
+			lock = self._chat_locks[key] = asyncio.Lock()
+		self._chat_refs[key] = self._chat_refs.get(key, 0) + 1
+		try:
+			async with lock:
+				async with self._workers:
+					await coroutine
+		finally:
+			self._chat_refs[key] -= 1
+			if not self._chat_refs[key]:
+				# last update of this chat: drop the lock so the dict doesn't grow forever
+				del self._chat_refs[key]
+				del self._chat_locks[key]
+
+	async def initialize(self) -> None:
+		pass
+
+	async def shutdown(self) -> None:
+		pass
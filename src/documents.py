@@ -0,0 +1,283 @@
+import asyncio
+import hashlib
+from contextlib import closing
+import os
+import threading
+import time
+from typing import Any, Awaitable, Callable, Dict, Iterator, List, Optional
+
+from .ollama_client import chat_with_model
+from .routing import model_router
+from .settings import get_settings
+
+DEFAULT_TASK = "Кратко изложи ключевые моменты текста."
+
+ProgressCallback = Callable[[int, int], Awaitable[None]]
+
+
+def iter_chunks(path: str, size: int) -> Iterator[str]:
+	"""Stream a text file as chunks of at most `size` characters, split on line boundaries where possible."""
+	buf: List[str] = []
+	buf_len = 0
+	with open(path, 'r', encoding='utf-8', errors='replace') as f:
+		for line in f:
+			while len(line) > size:
+				# a single line longer than a chunk (minified JSON, base64, ...)
+				if buf:
+					yield "".join(buf)
+					buf, buf_len = [], 0
+				yield line[:size]
+				line = line[size:]
+			if buf_len + len(line) > size:
+				yield "".join(buf)
+				buf, buf_len = [], 0
+			buf.append(line)
+			buf_len += len(line)
+	if buf_len:
+		yield "".join(buf)
+
+
+def count_chunks(path: str, size: int) -> int:
+	return sum(1 for _ in iter_chunks(path, size))
+
+
+async def _next_chunk(chunks: Iterator[str]) -> Optional[str]:
+	"""Read the next chunk in a worker thread, None at the end.
+
+	If the caller is cancelled, the read is still waited for: the thread keeps
+	running inside the generator, and closing it meanwhile would raise
+	"generator already executing" instead of the CancelledError.
+	"""
+	read = asyncio.ensure_future(asyncio.to_thread(next, chunks, None))
+	try:
+		return await asyncio.shield(read)
+	except asyncio.CancelledError:
+		await asyncio.wait([read])
+		raise
+
+
+class ChunkCache:
+	"""On-disk cache of per-chunk model outputs so a retry skips completed chunks."""
+
+	def __init__(self, directory: str) -> None:
+		self._dir = directory
+
+	@staticmethod
+	def make_key(*parts: Any) -> str:
+		h = hashlib.sha256()
+		for part in parts:
+			h.update(str(part).encode('utf-8'))
+			h.update(b"\0")
+		return h.hexdigest()
+
+	def _path(self, key: str) -> str:
+		return os.path.join(self._dir, f"{key}.txt")
+
+	def get(self, key: str) -> Optional[str]:
+		try:
+			with open(self._path(key), 'r', encoding='utf-8') as f:
+				return f.read()
+		except FileNotFoundError:
+			return None
+
+	def put(self, key: str, text: str) -> None:
+		tmp_path = f"{self._path(key)}.tmp"
+		with open(tmp_path, 'w', encoding='utf-8') as f:
+			f.write(text)
+		os.replace(tmp_path, self._path(key))
+
+	def prepare(self, max_age_seconds: float) -> None:
+		"""Create the cache directory and drop stale entries (blocking; run in a thread)."""
+		os.makedirs(self._dir, exist_ok=True)
+		self.prune(max_age_seconds)
+
+	def prune(self, max_age_seconds: float) -> None:
+		"""Remove cache entries older than `max_age_seconds`."""
+		cutoff = time.time() - max_age_seconds
+		try:
+			for entry in os.scandir(self._dir):
+				if entry.is_file() and entry.stat().st_mtime < cutoff:
+					os.remove(entry.path)
+		except OSError as e:
+			print(f"Failed to prune document cache: {e}")
+
+
+def get_upload_dir() -> str:
+	path = os.path.join(get_settings().doc_cache_dir, "uploads")
+	os.makedirs(path, exist_ok=True)
+	return path
+
+
+def remove_upload(path: str) -> None:
+	try:
+		os.remove(path)
+	except OSError:
+		pass
+
+
+class DocumentJob:
+	"""Map-reduce over a text file on disk using a single model and generation settings."""
+
+	def __init__(
+		self,
+		model: str,
+		*,
+		task: str = DEFAULT_TASK,
+		system_prompt: str = "",
+		temperature: float = 0.7,
+		top_p: float = 0.9,
+		max_tokens: int = 512,
+		cancel_event: Optional[threading.Event] = None,
+	) -> None:
+		settings = get_settings()
+		self.model = model
+		self.task = task or DEFAULT_TASK
+		self.system_prompt = system_prompt
+		self.temperature = temperature
+		self.top_p = top_p
+		self.max_tokens = max_tokens
+		# set to abort the requests of a job that is being cancelled
+		self.cancel_event = cancel_event
+		self.chunk_chars = settings.doc_chunk_chars
+		self.concurrency = settings.doc_map_concurrency
+		self.cache_ttl_seconds = settings.doc_cache_ttl_seconds
+		self.cache = ChunkCache(os.path.join(settings.doc_cache_dir, "chunks"))
+
+	def _ask(self, prompt: str) -> Dict[str, Any]:
+		messages = []
+		if self.system_prompt:
+			messages.append({"role": "system", "content": self.system_prompt})
+		messages.append({"role": "user", "content": prompt})
+		return chat_with_model(
+			self.model,
+			messages,
+			temperature=self.temperature,
+			top_p=self.top_p,
+			num_predict=self.max_tokens,
+			cancel_event=self.cancel_event,
+		)
+
+	async def _cached_ask(self, stage: str, prompt: str) -> Dict[str, Any]:
+		key = ChunkCache.make_key(
+			stage, self.model, self.system_prompt, self.temperature, self.top_p, self.max_tokens, prompt
+		)
+		cached = await asyncio.to_thread(self.cache.get, key)
+		if cached is not None:
+			return {"ok": True, "text": cached, "error": None}
+		with model_router.track(self.model):
+			resp = await asyncio.to_thread(self._ask, prompt)
+		model_router.observe(self.model, resp.get("stats"))
+		if resp.get("ok"):
+			await asyncio.to_thread(self.cache.put, key, resp.get("text") or "")
+		return resp
+
+	def _map_prompt(self, index: int, total: int, chunk: str) -> str:
+		return f"{self.task}\n\nФрагмент {index + 1} из {total}:\n\n{chunk}"
+
+	def _reduce_prompt(self, partials: List[str]) -> str:
+		joined = "\n\n".join(f"[Часть {i + 1}]\n{text}" for i, text in enumerate(partials))
+		return (
+			"Ниже — результаты обработки частей одного документа. "
+			f"Объедини их в один связный ответ на задачу: {self.task}\n\n{joined}"
+		)
+
+	async def _map(self, path: str, total: int, on_progress: Optional[ProgressCallback]) -> List[str]:
+		"""Run the map step with bounded parallelism.
+
+		Chunks are fed through a small queue so only about 2x `concurrency` chunks
+		are held in memory regardless of the document size.
+		"""
+		results: List[Optional[str]] = [None] * total
+		queue: asyncio.Queue = asyncio.Queue(maxsize=self.concurrency)
+		errors: List[str] = []
+		done = 0
+
+		async def worker() -> None:
+			nonlocal done
+			while True:
+				item = await queue.get()
+				try:
+					if item is None:
+						return
+					index, chunk = item
+					if errors:
+						continue
+					resp = await self._cached_ask("map", self._map_prompt(index, total, chunk))
+					if not resp.get("ok"):
+						errors.append(str(resp.get("error")))
+						continue
+					results[index] = resp.get("text") or ""
+					done += 1
+					if on_progress:
+						await on_progress(done, total)
+				except Exception as e:
+					errors.append(str(e))
+				finally:
+					queue.task_done()
+
+		workers = [asyncio.create_task(worker()) for _ in range(self.concurrency)]
+		chunks = iter_chunks(path, self.chunk_chars)
+		try:
+			index = 0
+			while not errors:
+				chunk = await _next_chunk(chunks)
+				if chunk is None:
+					break
+				await queue.put((index, chunk))
+				index += 1
+			for _ in workers:
+				await queue.put(None)
+			await asyncio.gather(*workers)
+		finally:
+			chunks.close()
+			for w in workers:
+				w.cancel()
+		if errors:
+			raise RuntimeError(errors[0])
+		return [text or "" for text in results]
+
+	async def _reduce(self, partials: List[str]) -> str:
+		"""Combine partial results, in several rounds if they don't fit into one prompt."""
+		semaphore = asyncio.Semaphore(self.concurrency)
+
+		async def reduce_group(group: List[str]) -> str:
+			async with semaphore:
+				resp = await self._cached_ask("reduce", self._reduce_prompt(group))
+			if not resp.get("ok"):
+				raise RuntimeError(str(resp.get("error")))
+			return resp.get("text") or ""
+
+		while True:
+			groups: List[List[str]] = [[]]
+			size = 0
+			for text in partials:
+				# at least two partials per group so every round shrinks the list
+				if len(groups[-1]) >= 2 and size + len(text) > self.chunk_chars:
+					groups.append([])
+					size = 0
+				groups[-1].append(text)
+				size += len(text)
+			if len(groups) == 1:
+				return await reduce_group(groups[0])
+			partials = list(await asyncio.gather(*(reduce_group(group) for group in groups)))
+
+	async def run(self, path: str, on_progress: Optional[ProgressCallback] = None) -> Dict[str, Any]:
+		"""Process the file and return {"ok", "text", "error", "chunks"}."""
+		try:
+			await asyncio.to_thread(self.cache.prepare, self.cache_ttl_seconds)
+			total = await asyncio.to_thread(count_chunks, path, self.chunk_chars)
+			if total == 0:
+				return {"ok": False, "text": None, "error": "документ пуст", "chunks": 0}
+			if total == 1:
+				# fits into one request, no reduce step needed
+				with closing(iter_chunks(path, self.chunk_chars)) as chunks:
+					chunk = await _next_chunk(chunks)
+				resp = await self._cached_ask("map", f"{self.task}\n\n{chunk}")
+				if on_progress:
+					await on_progress(1, 1)
+				return {**resp, "chunks": 1}
+			partials = await self._map(path, total, on_progress)
+			text = await self._reduce(partials)
+			return {"ok": True, "text": text, "error": None, "chunks": total}
+		except Exception as e:
+			return {"ok": False, "text": None, "error": str(e), "chunks": 0}
@@ -0,0 +1,201 @@
+import asyncio
+import hashlib
+import threading
+import time
+from typing import Any, Dict, Optional, Tuple
+
+from telegram import InlineQueryResultArticle, InputTextMessageContent, Update
+from telegram.ext import ContextTypes
+
+from .ollama_client import stream_chat_with_model
+from .routing import model_router
+from .session import session_manager
+from .settings import TELEGRAM_MESSAGE_LIMIT, get_settings
+from . import texts
+
+
+class _TTLCache:
+	"""Tiny in-memory cache of inline answers with per-entry expiry."""
+
+	def __init__(self) -> None:
+		self._items: Dict[tuple, Tuple[float, str]] = {}
+
+	def get(self, key: tuple) -> Optional[str]:
+		item = self._items.get(key)
+		if item is None:
+			return None
+		expires, text = item
+		if expires < time.monotonic():
+			del self._items[key]
+			return None
+		return text
+
+	def put(self, key: tuple, text: str, ttl: float) -> None:
+		now = time.monotonic()
+		if len(self._items) > 1000:
+			self._items = {k: v for k, v in self._items.items() if v[0] >= now}
+		self._items[key] = (now + ttl, text)
+
+
+_cache = _TTLCache()
+# user_id -> latest inline request: {"job", "key", "generation", "cancel", "requested_model"}
+_user_requests: Dict[int, Dict[str, Any]] = {}
+
+
+def _collect_stream(model: str, messages: list, options: dict, cancel_event: threading.Event) -> Dict[str, Any]:
+	"""Run a cancellable streaming generation to completion (called in a worker thread)."""
+	parts = []
+	stats: Dict[str, Any] = {}
+	try:
+		for delta in stream_chat_with_model(model, messages, cancel_event=cancel_event, stats_out=stats, **options):
+			parts.append(delta)
+		if cancel_event.is_set():
+			return {"ok": False, "text": None, "error": "cancelled", "stats": None}
+		return {"ok": True, "text": "".join(parts), "error": None, "stats": stats}
+	except Exception as e:
+		return {"ok": False, "text": None, "error": str(e), "stats": None}
+
+
+async def _generate(user_id: int, prompt: str, model: str, messages: list, options: dict, cancel_event: threading.Event) -> Dict[str, Any]:
+	"""Run the generation registered with the shutdown drain, which waits for it or sets `cancel_event`."""
+	request = await session_manager.begin_request(user_id, None, prompt, cancel_event)
+	if request is None:
+		return {"ok": False, "text": None, "error": texts.BOT_DRAINING, "stats": None}
+	try:
+		await session_manager.note_served_model(user_id, model)
+		return await asyncio.to_thread(_collect_stream, model, messages, options, cancel_event)
+	finally:
+		await session_manager.end_request(request)
+
+
+def _article(title: str, text: str, description: str = "") -> InlineQueryResultArticle:
+	return InlineQueryResultArticle(
+		id=hashlib.sha1(f"{title}\0{text}".encode('utf-8')).hexdigest(),
+		title=title[:64],
+		description=description[:100],
+		input_message_content=InputTextMessageContent(text[:TELEGRAM_MESSAGE_LIMIT]),
+	)
+
+
+def _cancel_previous(user_id: int, key: tuple) -> Tuple[Optional[asyncio.Future], threading.Event]:
+	"""Cancel the user's superseded request.
+
+	If it is still generating the very same prompt, that generation is handed over
+	(with its cancel event) instead of being aborted and started again.
+	"""
+	prev = _user_requests.get(user_id)
+	if not prev:
+		return None, threading.Event()
+	prev["job"].cancel()
+	generation = prev.get("generation")
+	if prev["key"] == key and generation is not None and not generation.done():
+		return generation, prev["cancel"]
+	prev["cancel"].set()
+	return None, threading.Event()
+
+
+async def _answer_query(update: Update, state: Dict[str, Any], prompt: str, model: str, messages: list, options: dict) -> None:
+	settings = get_settings()
+	query = update.inline_query
+	key = state["key"]
+	reuse = state.get("generation")
+
+	# Debounce: a newer keystroke cancels this job while it sleeps
+	if reuse is None:
+		await asyncio.sleep(settings.inline_debounce_seconds)
+
+	cached = _cache.get(key)
+	if cached is None:
+		generation = reuse
+		if generation is None:
+			generation = asyncio.ensure_future(
+				_generate(query.from_user.id, prompt, model, messages, options, state["cancel"])
+			)
+			# the generation may outlive this job, so load is tracked until it finishes
+			model_router.acquire(model)
+
+			def _store(fut: asyncio.Future) -> None:
+				model_router.release(model)
+				if fut.cancelled():
+					return
+				resp = fut.result()
+				model_router.observe(model, resp.get("stats"))
+				if resp.get("ok"):
+					_cache.put(key, resp.get("text") or "", get_settings().inline_cache_ttl_seconds)
+
+			generation.add_done_callback(_store)
+		state["generation"] = generation
+		try:
+			resp = await asyncio.wait_for(asyncio.shield(generation), settings.inline_answer_timeout_seconds)
+		except asyncio.TimeoutError:
+			# Keep generating into the cache; the same query shortly after is answered from it
+			await query.answer([_article(texts.INLINE_STILL_GENERATING, texts.INLINE_STILL_GENERATING)], cache_time=0, is_personal=True)
+			return
+		if not resp.get("ok"):
+			await query.answer([_article(texts.INLINE_ERROR, f"{texts.INLINE_ERROR}: {resp.get('error')}")], cache_time=0, is_personal=True)
+			return
+		cached = resp.get("text") or ""
+
+	if model != state["requested_model"]:
+		cached += texts.ROUTED_NOTE.format(model=model)
+	await query.answer(
+		[_article(prompt, f"❓ {prompt}\n\n{cached}", description=cached)],
+		cache_time=settings.inline_cache_ttl_seconds,
+		is_personal=True,
+	)
+
+
+async def handle_inline_query(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+	query = update.inline_query
+	if not query:
+		return
+	prompt = (query.query or "").strip()
+	if not prompt:
+		return
+	user_id = query.from_user.id
+
+	sess = await session_manager.get_status(user_id)
+	locked_by = await session_manager.get_busy_info()
+	if session_manager.is_draining():
+		await query.answer([_article(texts.BOT_DRAINING, texts.BOT_DRAINING)], cache_time=0, is_personal=True)
+		return
+	if locked_by is not None and locked_by != user_id:
+		busy = f"🤖 Бот занят пользователем {locked_by}. Попробуйте позже."
+		await query.answer([_article(busy, busy)], cache_time=0, is_personal=True)
+		return
+	if not sess.model_id:
+		await query.answer([_article(texts.NEED_SELECT_MODEL, texts.NEED_SELECT_MODEL)], cache_time=0, is_personal=True)
+		return
+
+	settings = get_settings()
+	options = {
+		"temperature": sess.temperature,
+		"top_p": sess.top_p,
+		"num_predict": min(sess.max_tokens, settings.inline_max_tokens),
+	}
+	# Under load a lighter fallback may answer; the cache is keyed by the model that actually serves
+	model = model_router.choose(sess.model_id)
+	key = (model, sess.system_prompt, options["temperature"], options["top_p"], options["num_predict"], prompt)
+	messages = []
+	if sess.system_prompt:
+		messages.append({"role": "system", "content": sess.system_prompt})
+	messages.append({"role": "user", "content": prompt})
+
+	reuse, cancel_event = _cancel_previous(user_id, key)
+	state: Dict[str, Any] = {"key": key, "generation": reuse, "cancel": cancel_event, "requested_model": sess.model_id}
+	job = asyncio.ensure_future(_answer_query(update, state, prompt, model, messages, options))
+	state["job"] = job
+	_user_requests[user_id] = state
+	try:
+		await job
+	except asyncio.CancelledError:
+		# superseded by a newer query from the same user
+		if not job.cancelled():
+			raise
+	except Exception as e:
+		print(f"Inline query failed for user {user_id}: {e}")
+	finally:
+		if _user_requests.get(user_id) is state:
+			generation = state.get("generation")
+			if generation is None or generation.done():
+				del _user_requests[user_id]
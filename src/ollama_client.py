@@ -1,16 +1,21 @@
-from typing import Optional, List, Dict, Any, Iterator
+from typing import Optional, List, Dict, Any, Iterator, Tuple
 import os
+import threading
 import time
 import subprocess
 import requests
 
+from .settings import get_settings
+
 
 def get_ollama_base_url() -> str:
 	return os.getenv("OLLAMA_HOST", "http://127.0.0.1:11434")
 
 
-def ping_ollama(timeout: float = 2.0) -> Optional[str]:
+def ping_ollama(timeout: Optional[float] = None) -> Optional[str]:
 	base = get_ollama_base_url()
+	if timeout is None:
+		timeout = get_settings().ollama_ping_timeout
 	try:
 		resp = requests.get(f"{base}/api/version", timeout=timeout)
 		if resp.status_code == 200:
@@ -21,8 +26,10 @@ def ping_ollama(timeout: float = 2.0) -> Optional[str]:
 		return None
 
 
-def list_ollama_models(timeout: float = 3.0) -> List[str]:
+def list_ollama_models(timeout: Optional[float] = None) -> List[str]:
 	base = get_ollama_base_url()
+	if timeout is None:
+		timeout = get_settings().ollama_list_timeout
 	try:
 		resp = requests.get(f"{base}/api/tags", timeout=timeout)
 		resp.raise_for_status()
@@ -33,6 +40,46 @@ def list_ollama_models(timeout: float = 3.0) -> List[str]:
 		return []
 
 
+def _extract_stats(data: Dict[str, Any]) -> Dict[str, Any]:
+	"""Timing counters Ollama attaches to a finished response (durations are in ns)."""
+	keys = ("eval_count", "eval_duration", "prompt_eval_count", "prompt_eval_duration", "load_duration", "total_duration")
+	return {key: data[key] for key in keys if isinstance(data.get(key), (int, float))}
+
+
+def _collect_cancellable(
+	url: str, payload: Dict[str, Any], timeout: float, cancel_event: threading.Event
+) -> Optional[Tuple[str, Dict[str, Any]]]:
+	"""Run a request in streaming mode and join the chunks.
+
+	Returns (text, final chunk), or None once `cancel_event` is set; leaving the
+	stream closes the connection, which makes Ollama abort the generation.
+	`timeout` bounds the whole answer, not just the wait for each chunk, and
+	raises TimeoutError when exceeded.
+	"""
+	if cancel_event.is_set():
+		return None
+	deadline = time.monotonic() + timeout
+	parts: List[str] = []
+	final: Dict[str, Any] = {}
+	with requests.post(url, json={**payload, "stream": True}, stream=True, timeout=timeout) as resp:
+		resp.raise_for_status()
+		for line in resp.iter_lines(decode_unicode=True):
+			if cancel_event.is_set():
+				return None
+			if time.monotonic() > deadline:
+				raise TimeoutError(f"no complete answer within {timeout:g}s")
+			if not line:
+				continue
+			data = requests.utils.json.loads(line)
+			if data.get("error"):
+				raise RuntimeError(data["error"])
+			parts.append((data.get("message") or {}).get("content") or data.get("response") or "")
+			if data.get("done"):
+				final = data
+				break
+	return "".join(parts), final
+
+
 def chat_with_model(
 	model: str,
 	messages: List[Dict[str, str]],
@@ -40,10 +87,17 @@ def chat_with_model(
 	temperature: float = 0.7,
 	top_p: float = 0.9,
 	num_predict: int = 512,
-	timeout: float = 120.0,
+	timeout: Optional[float] = None,
+	cancel_event: Optional[threading.Event] = None,
 ) -> Dict[str, Any]:
-	"""Non-streaming chat request to Ollama."""
+	"""Chat request to Ollama returning the whole answer at once.
+
+	With `cancel_event` the answer is streamed internally so setting the event
+	aborts the generation; the result then has error "cancelled".
+	"""
 	base = get_ollama_base_url()
+	if timeout is None:
+		timeout = get_settings().ollama_chat_timeout
 	payload = {
 		"model": model,
 		"messages": messages,
@@ -55,20 +109,86 @@ def chat_with_model(
 		},
 	}
 	try:
-		resp = requests.post(
-			f"{base}/api/chat",
-			json=payload,
-			timeout=timeout,
-		)
-		resp.raise_for_status()
-		data = resp.json() or {}
-		message = (data.get("message") or {})
-		text = message.get("content") or data.get("response")
+		if cancel_event is not None:
+			collected = _collect_cancellable(f"{base}/api/chat", payload, timeout, cancel_event)
+			if collected is None:
+				return {"ok": False, "text": None, "error": "cancelled", "stats": None}
+			text, data = collected
+		else:
+			resp = requests.post(
+				f"{base}/api/chat",
+				json=payload,
+				timeout=timeout,
+			)
+			resp.raise_for_status()
+			data = resp.json() or {}
+			message = (data.get("message") or {})
+			text = message.get("content") or data.get("response")
+		if not isinstance(text, str):
+			text = str(text) if text is not None else ""
+		return {"ok": True, "text": text, "error": None, "stats": _extract_stats(data)}
+	except Exception as e:
+		return {"ok": False, "text": None, "error": str(e), "stats": None}
+
+
+def generate_with_context(
+	model: str,
+	prompt: str,
+	*,
+	system: str = "",
+	context: Optional[List[int]] = None,
+	temperature: float = 0.7,
+	top_p: float = 0.9,
+	num_predict: int = 512,
+	timeout: Optional[float] = None,
+	cancel_event: Optional[threading.Event] = None,
+) -> Dict[str, Any]:
+	"""/api/generate request that continues from a previous `context`.
+
+	Ollama returns the updated token context with every reply, so the caller can
+	send only the new prompt next turn instead of replaying the whole dialogue.
+	`cancel_event` works as in `chat_with_model`.
+	"""
+	base = get_ollama_base_url()
+	if timeout is None:
+		timeout = get_settings().ollama_chat_timeout
+	payload: Dict[str, Any] = {
+		"model": model,
+		"prompt": prompt,
+		"stream": False,
+		"options": {
+			"temperature": temperature,
+			"top_p": top_p,
+			"num_predict": num_predict,
+		},
+	}
+	if system:
+		payload["system"] = system
+	if context:
+		payload["context"] = context
+	try:
+		if cancel_event is not None:
+			collected = _collect_cancellable(f"{base}/api/generate", payload, timeout, cancel_event)
+			if collected is None:
+				return {"ok": False, "text": None, "context": None, "error": "cancelled", "stats": None}
+			text, data = collected
+		else:
+			resp = requests.post(
+				f"{base}/api/generate",
+				json=payload,
+				timeout=timeout,
+			)
+			resp.raise_for_status()
+			data = resp.json() or {}
+			text = data.get("response")
 		if not isinstance(text, str):
 			text = str(text) if text is not None else ""
-		return {"ok": True, "text": text, "error": None}
+		new_context = data.get("context")
+		if not isinstance(new_context, list):
+			new_context = None
+		return {"ok": True, "text": text, "context": new_context, "error": None, "stats": _extract_stats(data)}
 	except Exception as e:
-		return {"ok": False, "text": None, "error": str(e)}
+		return {"ok": False, "text": None, "context": None, "error": str(e), "stats": None}
 
 
 def stream_chat_with_model(
@@ -78,13 +198,20 @@ def stream_chat_with_model(
 	temperature: float = 0.7,
 	top_p: float = 0.9,
 	num_predict: int = 512,
-	timeout: float = 300.0,
+	timeout: Optional[float] = None,
+	cancel_event: Optional[threading.Event] = None,
+	stats_out: Optional[Dict[str, Any]] = None,
 ) -> Iterator[str]:
 	"""Streaming chat request to Ollama. Yields text deltas as they arrive.
 
 	This uses the streaming API (stream=true) and yields incremental content.
+	Setting `cancel_event` stops the stream and closes the connection, which makes
+	Ollama abort the generation. Timing counters from the final chunk are copied
+	into `stats_out` if given.
 	"""
 	base = get_ollama_base_url()
+	if timeout is None:
+		timeout = get_settings().ollama_stream_timeout
 	payload = {
 		"model": model,
 		"messages": messages,
@@ -98,12 +225,16 @@ def stream_chat_with_model(
 	with requests.post(f"{base}/api/chat", json=payload, stream=True, timeout=timeout) as resp:
 		resp.raise_for_status()
 		for line in resp.iter_lines(decode_unicode=True):
+			if cancel_event is not None and cancel_event.is_set():
+				break
 			if not line:
 				continue
 			try:
 				data = requests.utils.json.loads(line)
 				msg = (data.get("message") or {})
 				chunk = msg.get("content") or data.get("response") or ""
+				if data.get("done") and stats_out is not None:
+					stats_out.update(_extract_stats(data))
 				if chunk:
 					yield str(chunk)
 			except Exception:
@@ -111,9 +242,11 @@ def stream_chat_with_model(
 				continue
 
 
-def warm_up_model(model: str, timeout: float = 180.0) -> Dict[str, Any]:
+def warm_up_model(model: str, timeout: Optional[float] = None) -> Dict[str, Any]:
 	"""Trigger a tiny non-stream generation to load model into memory."""
 	base = get_ollama_base_url()
+	if timeout is None:
+		timeout = get_settings().ollama_warmup_timeout
 	payload = {
 		"model": model,
 		"prompt": "ok",
@@ -131,8 +264,10 @@ def warm_up_model(model: str, timeout: float = 180.0) -> Dict[str, Any]:
 		return {"ok": False, "error": str(e)}
 
 
-def stop_model_cli(model: str, timeout: float = 30.0) -> Dict[str, Any]:
+def stop_model_cli(model: str, timeout: Optional[float] = None) -> Dict[str, Any]:
 	"""Fallback: call `ollama stop <model>` via CLI."""
+	if timeout is None:
+		timeout = get_settings().ollama_stop_timeout
 	try:
 		proc = subprocess.run([
 			"ollama", "stop", model
@@ -144,6 +279,8 @@ def stop_model_cli(model: str, timeout: float = 30.0) -> Dict[str, Any]:
 		return {"ok": False, "error": str(e)}
 
 
-def unload_model(model: str, timeout: float = 60.0) -> Dict[str, Any]:
+def unload_model(model: str, timeout: Optional[float] = None) -> Dict[str, Any]:
 	"""Unload a model using the Ollama CLI stop command (requested behavior)."""
+	if timeout is None:
+		timeout = get_settings().ollama_unload_timeout
 	return stop_model_cli(model, timeout=timeout)
@@ -0,0 +1,104 @@
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import Any, Dict, Iterator, Optional
+
+from .settings import get_settings
+
+# Weight of the newest measurement in the moving averages
+EWMA_ALPHA = 0.3
+
+
+@dataclass
+class ModelLoad:
+	"""Live load signals for one model."""
+	inflight: int = 0
+	tokens_per_sec: Optional[float] = None  # EWMA of generation speed
+	ttft_seconds: Optional[float] = None  # EWMA of prompt processing time
+	updated_at: float = 0.0
+
+
+def _ewma(old: Optional[float], new: float) -> float:
+	return new if old is None else EWMA_ALPHA * new + (1 - EWMA_ALPHA) * old
+
+
+class ModelRouter:
+	"""Reroute requests to lighter fallback models while the requested one is over its SLO.
+
+	Fallback chains come from `model_fallbacks` in settings. Signals are the number of
+	requests in flight per model and the tokens/s and time-to-first-token reported by
+	Ollama. Measurements older than `route_stats_ttl_seconds` are ignored, so a model
+	that was rerouted away from gets tried again once they expire.
+	"""
+
+	def __init__(self) -> None:
+		self._load: Dict[str, ModelLoad] = {}
+
+	def _get(self, model: str) -> ModelLoad:
+		load = self._load.get(model)
+		if load is None:
+			load = self._load[model] = ModelLoad()
+		return load
+
+	def is_overloaded(self, model: str) -> bool:
+		settings = get_settings()
+		load = self._load.get(model)
+		if load is None:
+			return False
+		if settings.route_max_queue_depth and load.inflight >= settings.route_max_queue_depth:
+			return True
+		if time.monotonic() - load.updated_at > settings.route_stats_ttl_seconds:
+			return False
+		if settings.route_min_tokens_per_sec and load.tokens_per_sec is not None:
+			if load.tokens_per_sec < settings.route_min_tokens_per_sec:
+				return True
+		if settings.route_max_ttft_seconds and load.ttft_seconds is not None:
+			if load.ttft_seconds > settings.route_max_ttft_seconds:
+				return True
+		return False
+
+	def choose(self, model: str) -> str:
+		"""Return the model that should serve a request for `model` right now."""
+		chain = get_settings().model_fallbacks.get(model)
+		if not chain:
+			return model
+		candidates = (model,) + chain
+		for candidate in candidates:
+			if not self.is_overloaded(candidate):
+				return candidate
+		# everything is over the SLO: the lightest variant is the best bet
+		return candidates[-1]
+
+	def acquire(self, model: str) -> None:
+		"""Count a request as in flight for `model` (queue depth signal)."""
+		self._get(model).inflight += 1
+
+	def release(self, model: str) -> None:
+		self._get(model).inflight -= 1
+
+	@contextmanager
+	def track(self, model: str) -> Iterator[None]:
+		self.acquire(model)
+		try:
+			yield
+		finally:
+			self.release(model)
+
+	def observe(self, model: str, stats: Optional[Dict[str, Any]]) -> None:
+		"""Feed timing counters from an Ollama response into the moving averages."""
+		if not stats:
+			return
+		load = self._get(model)
+		eval_count = stats.get("eval_count") or 0
+		eval_duration = stats.get("eval_duration") or 0
+		if eval_count and eval_duration:
+			load.tokens_per_sec = _ewma(load.tokens_per_sec, eval_count / (eval_duration / 1e9))
+		# load_duration is left out: a cold start of a fallback is a one-off, not a sign of overload
+		first_token_ns = stats.get("prompt_eval_duration") or 0
+		if first_token_ns:
+			load.ttft_seconds = _ewma(load.ttft_seconds, first_token_ns / 1e9)
+		load.updated_at = time.monotonic()
+
+
+# singleton instance
+model_router = ModelRouter()
@@ -1,8 +1,15 @@
 import asyncio
 import json
 import os
-from dataclasses import dataclass, field
-from typing import Dict, Optional, Set
+import threading
+from dataclasses import asdict, dataclass, field, replace
+from typing import Any, Dict, List, Optional, Set
+
+# Number of per-user lock stripes; users hash onto a stripe by id
+LOCK_STRIPES = 64
+
+# Session fields that `set_param` may change
+_SETTABLE_PARAMS = {"temperature", "top_p", "max_tokens", "system_prompt"}
 
 
 @dataclass
@@ -16,20 +23,58 @@ class UserSession:
 	system_prompt: str = ""
 	history: list = field(default_factory=list)
 	pending_action: Optional[str] = None  # e.g., 'settemp', 'settopp', 'setmax', 'system'
+	# incremental mode: continue from Ollama's /api/generate context instead of replaying history
+	context_mode: bool = False
+	context_tokens: Optional[list] = None
+	context_key: Optional[tuple] = None  # (model, system_prompt, temperature, top_p, max_tokens) the context was built with
+	# bumped whenever the history is reset, so results of a generation started before are dropped
+	history_epoch: int = 0
 
 
 class SessionManager:
+	"""Per-user sessions plus the global bot lock.
+
+	Session updates take only the user's lock stripe, so users never contend with
+	each other. Global state (bot lock, loaded models, in-flight requests) uses
+	`_lock`; when both are needed, `_lock` is taken first. Read-only queries take
+	no lock at all and return snapshots, which is safe because everything runs on
+	one event loop and reads never await.
+	"""
+
 	def __init__(self) -> None:
 		self._user_sessions: Dict[int, UserSession] = {}
 		self._bot_locked_by: Optional[int] = None  # Single user who locked the entire bot
 		self._loaded_models: Set[str] = set()  # Track loaded models
+		self._fallback_models: Dict[int, Set[str]] = {}  # user_id -> fallbacks the router served the user with
 		self._active_users: Set[int] = set()  # Track users who have interacted with bot
 		self._lock = asyncio.Lock()
+		self._stripes = [asyncio.Lock() for _ in range(LOCK_STRIPES)]
+		self._users_file_lock = asyncio.Lock()
 		self._users_file = "active_users.json"
 		self._load_active_users()
+		# Graceful shutdown: in-flight generations and state persisted across restarts
+		self._draining = False
+		# request token -> {"user_id", "chat_id", "text", "task", "cancel"}; one user may have several at once
+		self._inflight: Dict[int, Dict[str, Any]] = {}
+		self._next_request = 0
+		self._idle = asyncio.Event()
+		self._idle.set()
+		self._state_file = "session_state.json"
+		self._interrupted: List[Dict[str, Any]] = []  # requests cut off by the previous shutdown
+		self._load_state()
+
+	def _user_lock(self, user_id: int) -> asyncio.Lock:
+		return self._stripes[hash(user_id) % LOCK_STRIPES]
+
+	def _session(self, user_id: int) -> UserSession:
+		"""Get or create the live session. Callers must hold the user's stripe."""
+		sess = self._user_sessions.get(user_id)
+		if sess is None:
+			sess = self._user_sessions[user_id] = UserSession(user_id=user_id)
+		return sess
 
 	async def select_model(self, user_id: int, model_id: str) -> tuple[bool, str]:
-		async with self._lock:
+		async with self._lock, self._user_lock(user_id):
 			# Check if bot is locked by another user
 			if self._bot_locked_by is not None and self._bot_locked_by != user_id:
 				return False, f"🤖 Бот занят пользователем {self._bot_locked_by}. Попробуйте позже."
@@ -38,24 +83,24 @@ class SessionManager:
 			self._bot_locked_by = user_id
 			self._loaded_models.add(model_id)  # Track loaded model
 			self._active_users.add(user_id)  # Track active user
-			sess = self._user_sessions.get(user_id) or UserSession(user_id=user_id)
-			sess.model_id = model_id
-			self._user_sessions[user_id] = sess
+			self._session(user_id).model_id = model_id
 			return True, f"Модель выбрана: {model_id}"
 
 	async def end_session(self, user_id: int) -> Optional[str]:
 		"""End session and return model_id that was unloaded (if any)."""
-		async with self._lock:
+		async with self._lock, self._user_lock(user_id):
 			sess = self._user_sessions.get(user_id)
 			if not sess:
 				return None
 			model_id = sess.model_id
 			
 			# Only unlock bot if this user was the one who locked it
+			fallbacks = self._fallback_models.pop(user_id, set())
 			if self._bot_locked_by == user_id:
 				self._bot_locked_by = None
 				if model_id:
 					self._loaded_models.discard(model_id)  # Remove from loaded models
+				self._loaded_models -= fallbacks
 			
 			# reset session to defaults
 			sess.model_id = None
@@ -64,50 +109,120 @@ class SessionManager:
 			sess.top_p = 0.9
 			sess.max_tokens = 512
 			sess.system_prompt = ""
-			sess.history.clear()
-			self._user_sessions[user_id] = sess
+			# replace rather than clear: snapshots handed out earlier keep their copy
+			sess.history = []
+			sess.history_epoch += 1
+			sess.context_mode = False
+			sess.context_tokens = None
+			sess.context_key = None
 			return model_id
 
 	async def get_status(self, user_id: int) -> UserSession:
-		async with self._lock:
-			return self._user_sessions.get(user_id) or UserSession(user_id=user_id)
+		"""Lock-free snapshot of the user's session. Mutate through the update methods."""
+		sess = self._user_sessions.get(user_id)
+		if sess is None:
+			return UserSession(user_id=user_id)
+		return replace(sess, history=list(sess.history))
 
 	async def who_locked_bot(self) -> Optional[int]:
-		async with self._lock:
-			return self._bot_locked_by
+		return self._bot_locked_by
 
 	async def set_pending(self, user_id: int, action: Optional[str]) -> None:
+		async with self._user_lock(user_id):
+			self._session(user_id).pending_action = action
+
+	async def set_param(self, user_id: int, name: str, value: Any, *, if_pending: Optional[str] = None) -> bool:
+		"""Set a generation setting and clear pending input in one step.
+
+		With `if_pending`, nothing changes (and False is returned) unless the user is
+		still waiting for that input, e.g. it was cancelled in the meantime.
+		"""
+		if name not in _SETTABLE_PARAMS:
+			raise ValueError(f"Unknown session parameter: {name}")
+		async with self._user_lock(user_id):
+			sess = self._session(user_id)
+			if if_pending is not None and sess.pending_action != if_pending:
+				return False
+			setattr(sess, name, value)
+			sess.pending_action = None
+			return True
+
+	async def append_turn(self, user_id: int, user_text: str, answer: str, max_messages: int, epoch: int) -> bool:
+		"""Append a user/assistant exchange, keeping the last `max_messages` entries.
+
+		`epoch` is the `history_epoch` of the snapshot the request started from; if the
+		history was cleared since, the turn is dropped and False is returned.
+		"""
+		async with self._user_lock(user_id):
+			sess = self._session(user_id)
+			if sess.history_epoch != epoch:
+				return False
+			sess.history = (sess.history + [("user", user_text), ("assistant", answer)])[-max_messages:]
+			return True
+
+	async def clear_history(self, user_id: int) -> None:
+		"""Drop the dialogue history and the Ollama context built from it."""
+		async with self._user_lock(user_id):
+			sess = self._session(user_id)
+			sess.history = []
+			sess.history_epoch += 1
+			sess.context_tokens = None
+			sess.context_key = None
+
+	async def set_context(self, user_id: int, tokens: Optional[list], key: Optional[tuple], epoch: int) -> None:
+		"""Store the Ollama context returned by an incremental generation."""
+		async with self._user_lock(user_id):
+			sess = self._session(user_id)
+			if sess.history_epoch != epoch:
+				return
+			sess.context_tokens = tokens
+			sess.context_key = key if tokens else None
+
+	async def toggle_context_mode(self, user_id: int) -> bool:
+		"""Flip incremental context mode and return the new value; any stored context is dropped."""
+		async with self._user_lock(user_id):
+			sess = self._session(user_id)
+			sess.context_mode = not sess.context_mode
+			sess.context_tokens = None
+			sess.context_key = None
+			return sess.context_mode
+
+	async def note_served_model(self, user_id: int, model: str) -> None:
+		"""Remember a fallback model that served the user so it is unloaded with the session."""
 		async with self._lock:
-			sess = self._user_sessions.get(user_id) or UserSession(user_id=user_id)
-			sess.pending_action = action
-			self._user_sessions[user_id] = sess
+			sess = self._user_sessions.get(user_id)
+			if sess is None or model == sess.model_id:
+				return
+			self._fallback_models.setdefault(user_id, set()).add(model)
+			self._loaded_models.add(model)
+
+	async def get_fallback_models(self, user_id: int) -> Set[str]:
+		"""Fallback models loaded for the user's requests (besides the selected model)."""
+		return set(self._fallback_models.get(user_id, ()))
 
 	async def get_loaded_models(self) -> Set[str]:
 		"""Get set of currently loaded models."""
-		async with self._lock:
-			return self._loaded_models.copy()
+		return self._loaded_models.copy()
 
 	async def unload_all_models(self) -> None:
 		"""Unload all tracked models (for shutdown)."""
 		async with self._lock:
 			self._loaded_models.clear()
+			self._fallback_models.clear()
 			self._bot_locked_by = None
 
 	async def get_active_users(self) -> Set[int]:
 		"""Get set of active users (for notifications)."""
-		async with self._lock:
-			return self._active_users.copy()
+		return self._active_users.copy()
 
 
 	async def is_bot_busy(self) -> bool:
 		"""Check if bot is busy (locked by any user)."""
-		async with self._lock:
-			return self._bot_locked_by is not None
+		return self._bot_locked_by is not None
 
 	async def get_busy_info(self) -> Optional[int]:
 		"""Get info about who locked the bot."""
-		async with self._lock:
-			return self._bot_locked_by
+		return self._bot_locked_by
 
 	def _load_active_users(self) -> None:
 		"""Load active users from file on startup."""
@@ -120,19 +235,148 @@ class SessionManager:
 		except Exception as e:
 			print(f"Failed to load active users: {e}")
 
-	def _save_active_users(self) -> None:
+	def _save_active_users(self, users: Optional[List[int]] = None) -> None:
 		"""Save active users to file."""
+		if users is None:
+			users = list(self._active_users)
 		try:
 			with open(self._users_file, 'w', encoding='utf-8') as f:
-				json.dump({'active_users': list(self._active_users)}, f, ensure_ascii=False, indent=2)
+				json.dump({'active_users': users}, f, ensure_ascii=False, indent=2)
 		except Exception as e:
 			print(f"Failed to save active users: {e}")
 
 	async def add_active_user(self, user_id: int) -> None:
 		"""Add user to active users list and save to file."""
+		# Fast path: every update calls this, but only a new user changes anything
+		if user_id in self._active_users:
+			return
+		self._active_users.add(user_id)
+		# Writes are serialised so an older snapshot never overwrites a newer one
+		async with self._users_file_lock:
+			await asyncio.to_thread(self._save_active_users, list(self._active_users))
+
+	# --- Drain / graceful shutdown ---
+
+	async def begin_request(
+		self,
+		user_id: int,
+		chat_id: Optional[int],
+		text: str,
+		cancel_event: Optional[threading.Event] = None,
+	) -> Optional[int]:
+		"""Register an in-flight generation.
+
+		`cancel_event` is set if the generation is still running at the drain
+		deadline, so the worker thread stops the Ollama request. Requests without a
+		chat (inline queries) are waited for but not persisted as interrupted.
+		Returns a token to pass to `end_request`, or None while the bot is draining.
+		"""
+		async with self._lock:
+			if self._draining:
+				return None
+			self._next_request += 1
+			token = self._next_request
+			self._inflight[token] = {
+				"user_id": user_id,
+				"chat_id": chat_id,
+				"text": text,
+				"task": asyncio.current_task(),
+				"cancel": cancel_event,
+			}
+			self._idle.clear()
+			return token
+
+	async def end_request(self, token: int) -> None:
+		"""Mark an in-flight generation as finished."""
+		async with self._lock:
+			self._inflight.pop(token, None)
+			if not self._inflight:
+				self._idle.set()
+
+	def is_draining(self) -> bool:
+		return self._draining
+
+	async def start_drain(self) -> None:
+		"""Stop admitting new generations."""
+		async with self._lock:
+			self._draining = True
+
+	async def wait_drained(self, timeout: float) -> bool:
+		"""Wait until all in-flight generations finish. Returns False on timeout."""
+		try:
+			await asyncio.wait_for(self._idle.wait(), timeout=timeout)
+			return True
+		except asyncio.TimeoutError:
+			return False
+
+	async def cancel_inflight(self) -> int:
+		"""Cancel generations still running after the drain deadline.
+
+		Their records are kept so `save_state` persists them as interrupted work.
+		"""
+		async with self._lock:
+			items = list(self._inflight.values())
+		cancelled = 0
+		for item in items:
+			# the task only awaits a worker thread; the event stops the thread itself
+			if item.get("cancel") is not None:
+				item["cancel"].set()
+			task = item.get("task")
+			if task is not None and not task.done():
+				task.cancel()
+				cancelled += 1
+		return cancelled
+
+	def pop_interrupted(self) -> List[Dict[str, Any]]:
+		"""Return requests interrupted by the previous shutdown (once)."""
+		items, self._interrupted = self._interrupted, []
+		return items
+
+	def _load_state(self) -> None:
+		"""Restore session settings and interrupted requests saved on shutdown.
+
+		Models are unloaded on shutdown, so `model_id` and pending input are not restored.
+		"""
+		try:
+			if not os.path.exists(self._state_file):
+				return
+			with open(self._state_file, 'r', encoding='utf-8') as f:
+				data = json.load(f)
+			for raw in data.get('sessions', []):
+				sess = UserSession(user_id=int(raw['user_id']))
+				sess.temperature = float(raw.get('temperature', sess.temperature))
+				sess.top_p = float(raw.get('top_p', sess.top_p))
+				sess.max_tokens = int(raw.get('max_tokens', sess.max_tokens))
+				sess.system_prompt = str(raw.get('system_prompt', ""))
+				sess.history = [tuple(item) for item in raw.get('history', [])]
+				sess.context_mode = bool(raw.get('context_mode', False))
+				self._user_sessions[sess.user_id] = sess
+			self._interrupted = list(data.get('interrupted', []))
+			print(f"Restored {len(self._user_sessions)} sessions and {len(self._interrupted)} interrupted requests")
+		except Exception as e:
+			print(f"Failed to load session state: {e}")
+
+	async def save_state(self) -> None:
+		"""Persist session settings/history and still-running requests."""
 		async with self._lock:
-			self._active_users.add(user_id)
+			sessions = []
+			for sess in self._user_sessions.values():
+				raw = asdict(sess)
+				# context tokens are tied to the models loaded in this process
+				for key in ('model_id', 'pending_action', 'context_tokens', 'context_key', 'history_epoch'):
+					raw.pop(key, None)
+				sessions.append(raw)
+			interrupted = [
+				{"user_id": item["user_id"], "chat_id": item["chat_id"], "text": item["text"]}
+				for item in self._inflight.values()
+				if item["chat_id"] is not None
+			]
 			self._save_active_users()
+		try:
+			with open(self._state_file, 'w', encoding='utf-8') as f:
+				json.dump({'sessions': sessions, 'interrupted': interrupted}, f, ensure_ascii=False, indent=2)
+		except Exception as e:
+			print(f"Failed to save session state: {e}")
 
 
 # singleton instance
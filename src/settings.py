@@ -0,0 +1,247 @@
+import json
+import os
+from dataclasses import dataclass, field, fields, replace
+from typing import Any, Dict, FrozenSet, Optional, Set, Tuple
+
+from dotenv import dotenv_values, load_dotenv
+
+from .constants import (
+	MAX_TELEGRAM_CHUNK,
+	MAX_HISTORY_MESSAGES,
+	CONTEXT_MAX_TOKENS,
+	INACTIVITY_TIMEOUT_SECONDS,
+	SHUTDOWN_DRAIN_TIMEOUT_SECONDS,
+	SHUTDOWN_UNLOAD_TIMEOUT_SECONDS,
+	DOC_CHUNK_CHARS,
+	DOC_MAP_CONCURRENCY,
+	DOC_MAX_BYTES,
+	DOC_CACHE_TTL_SECONDS,
+	MAX_CONCURRENT_CHATS,
+	INLINE_DEBOUNCE_SECONDS,
+	INLINE_CACHE_TTL_SECONDS,
+	INLINE_ANSWER_TIMEOUT_SECONDS,
+	INLINE_MAX_TOKENS,
+	ROUTE_MAX_QUEUE_DEPTH,
+	ROUTE_MIN_TOKENS_PER_SEC,
+	ROUTE_MAX_TTFT_SECONDS,
+	ROUTE_STATS_TTL_SECONDS,
+)
+
+# Telegram rejects messages longer than this
+TELEGRAM_MESSAGE_LIMIT = 4096
+
+# Settings read only when the application is built; a reload can't apply them
+_RESTART_REQUIRED = frozenset({"max_concurrent_chats"})
+
+
+@dataclass(frozen=True)
+class Settings:
+	"""Runtime-tunable settings. Defaults come from constants.py.
+
+	Every field can be overridden from the JSON settings file (same key), the
+	.env file or an environment variable (upper-cased key), in increasing order
+	of priority.
+	"""
+	max_telegram_chunk: int = MAX_TELEGRAM_CHUNK
+	max_history_messages: int = MAX_HISTORY_MESSAGES
+	context_max_tokens: int = CONTEXT_MAX_TOKENS
+	inactivity_timeout_seconds: int = INACTIVITY_TIMEOUT_SECONDS
+	shutdown_drain_timeout_seconds: float = SHUTDOWN_DRAIN_TIMEOUT_SECONDS
+	shutdown_unload_timeout_seconds: float = SHUTDOWN_UNLOAD_TIMEOUT_SECONDS
+	# read once when the application is built; changing it needs a restart
+	max_concurrent_chats: int = MAX_CONCURRENT_CHATS
+	# Ollama request timeouts (seconds)
+	ollama_ping_timeout: float = 2.0
+	ollama_list_timeout: float = 3.0
+	ollama_chat_timeout: float = 120.0
+	ollama_stream_timeout: float = 300.0
+	ollama_warmup_timeout: float = 180.0
+	ollama_stop_timeout: float = 30.0
+	ollama_unload_timeout: float = 60.0
+	# Map-reduce over long documents
+	doc_chunk_chars: int = DOC_CHUNK_CHARS
+	doc_map_concurrency: int = DOC_MAP_CONCURRENCY
+	doc_max_bytes: int = DOC_MAX_BYTES
+	doc_cache_dir: str = "doc_cache"
+	doc_cache_ttl_seconds: int = DOC_CACHE_TTL_SECONDS
+	# Inline mode (@bot prompt)
+	inline_debounce_seconds: float = INLINE_DEBOUNCE_SECONDS
+	inline_cache_ttl_seconds: int = INLINE_CACHE_TTL_SECONDS
+	inline_answer_timeout_seconds: float = INLINE_ANSWER_TIMEOUT_SECONDS
+	inline_max_tokens: int = INLINE_MAX_TOKENS
+	# Load-adaptive routing: model -> lighter fallbacks in order of preference
+	model_fallbacks: Dict[str, Tuple[str, ...]] = field(default_factory=dict)
+	route_max_queue_depth: int = ROUTE_MAX_QUEUE_DEPTH
+	route_min_tokens_per_sec: float = ROUTE_MIN_TOKENS_PER_SEC
+	route_max_ttft_seconds: float = ROUTE_MAX_TTFT_SECONDS
+	route_stats_ttl_seconds: int = ROUTE_STATS_TTL_SECONDS
+	# Telegram user ids allowed to run admin commands (e.g. /reloadsettings)
+	admin_user_ids: FrozenSet[int] = field(default_factory=frozenset)
+
+	def validate(self) -> None:
+		"""Raise ValueError if any value is out of range."""
+		if not (1 <= self.max_telegram_chunk <= TELEGRAM_MESSAGE_LIMIT):
+			raise ValueError(f"max_telegram_chunk must be in 1..{TELEGRAM_MESSAGE_LIMIT}")
+		# history slicing keeps the last (max_history_messages - 1) entries
+		if self.max_history_messages < 2:
+			raise ValueError("max_history_messages must be >= 2")
+		if self.context_max_tokens <= 0:
+			raise ValueError("context_max_tokens must be positive")
+		if self.inactivity_timeout_seconds <= 0:
+			raise ValueError("inactivity_timeout_seconds must be positive")
+		if self.max_concurrent_chats < 1:
+			raise ValueError("max_concurrent_chats must be >= 1")
+		if self.doc_chunk_chars < 500:
+			raise ValueError("doc_chunk_chars must be >= 500")
+		if self.doc_map_concurrency < 1:
+			raise ValueError("doc_map_concurrency must be >= 1")
+		if self.doc_max_bytes <= 0 or self.doc_cache_ttl_seconds <= 0:
+			raise ValueError("doc_max_bytes and doc_cache_ttl_seconds must be positive")
+		if not self.doc_cache_dir:
+			raise ValueError("doc_cache_dir must not be empty")
+		if min(self.route_max_queue_depth, self.route_min_tokens_per_sec, self.route_max_ttft_seconds) < 0:
+			raise ValueError("route_* thresholds must be >= 0")
+		if self.route_stats_ttl_seconds <= 0:
+			raise ValueError("route_stats_ttl_seconds must be positive")
+		for model, chain in self.model_fallbacks.items():
+			if model in chain:
+				raise ValueError(f"model_fallbacks: {model} falls back to itself")
+		if self.inline_debounce_seconds < 0:
+			raise ValueError("inline_debounce_seconds must be >= 0")
+		for f in fields(self):
+			if f.name.startswith(("ollama_", "shutdown_", "inline_")) and f.name != "inline_debounce_seconds":
+				if getattr(self, f.name) <= 0:
+					raise ValueError(f"{f.name} must be positive")
+
+
+def _parse_fallbacks(value: Any) -> Dict[str, Tuple[str, ...]]:
+	"""Accept a JSON object {"big": ["small", ...]} or "big=small,smaller;other=tiny"."""
+	if isinstance(value, str):
+		pairs = {}
+		for entry in value.split(";"):
+			if not entry.strip():
+				continue
+			model, sep, chain = entry.partition("=")
+			if not sep or not model.strip():
+				raise ValueError(entry)
+			pairs[model.strip()] = [item for item in chain.split(",")]
+		value = pairs
+	if not isinstance(value, dict):
+		raise ValueError(value)
+	result = {}
+	for model, chain in value.items():
+		if isinstance(chain, str):
+			# {"big": "small"}: a single fallback, not a sequence of characters
+			chain = [chain]
+		if not isinstance(chain, (list, tuple)):
+			raise ValueError(chain)
+		result[str(model).strip()] = tuple(str(item).strip() for item in chain if str(item).strip())
+	return result
+
+
+def _to_int(value: Any) -> int:
+	"""int() that refuses to silently truncate (2.7) or accept booleans."""
+	if isinstance(value, bool) or (isinstance(value, float) and not value.is_integer()):
+		raise ValueError(value)
+	return int(value)
+
+
+def _coerce(name: str, type_: Any, value: Any) -> Any:
+	try:
+		if name == "model_fallbacks":
+			return _parse_fallbacks(value)
+		if name == "admin_user_ids":
+			if isinstance(value, str):
+				value = [item for item in value.replace(";", ",").split(",") if item.strip()]
+			return frozenset(_to_int(item) for item in value)
+		if type_ is int:
+			return _to_int(value)
+		if type_ is float:
+			if isinstance(value, bool):
+				raise ValueError(value)
+			return float(value)
+		if type_ is str and not isinstance(value, str):
+			raise ValueError(value)
+	except (TypeError, ValueError, AttributeError):
+		raise ValueError(f"Invalid value for {name}: {value!r}")
+	return value
+
+
+def get_settings_file() -> str:
+	return os.getenv("SETTINGS_FILE", "settings.json")
+
+
+# Variables that load_env_file copied from .env into os.environ (as opposed to the real environment)
+_dotenv_keys: Set[str] = set()
+
+
+def load_env_file() -> None:
+	"""Load .env into os.environ at startup without overriding real environment variables."""
+	_dotenv_keys.update(key for key in dotenv_values() if key not in os.environ)
+	load_dotenv()
+
+
+def _get_env(name: str, dotenv: Dict[str, Optional[str]]) -> Optional[str]:
+	"""Real environment first, then the .env file as it is now (so edits are seen on reload)."""
+	if name in os.environ and name not in _dotenv_keys:
+		return os.environ[name]
+	return dotenv.get(name)
+
+
+def load_settings() -> Settings:
+	"""Build settings from defaults, the JSON settings file and the environment.
+
+	Raises ValueError if the file can't be parsed or a value is invalid.
+	"""
+	overrides: Dict[str, Any] = {}
+	path = get_settings_file()
+	if os.path.exists(path):
+		try:
+			with open(path, 'r', encoding='utf-8') as f:
+				data = json.load(f) or {}
+		except Exception as e:
+			raise ValueError(f"Failed to read {path}: {e}")
+		if not isinstance(data, dict):
+			raise ValueError(f"{path} must contain a JSON object")
+		overrides.update(data)
+	known = {f.name: f for f in fields(Settings)}
+	unknown = set(overrides) - set(known)
+	if unknown:
+		raise ValueError(f"Unknown settings: {', '.join(sorted(unknown))}")
+	dotenv = dotenv_values()
+	for name in known:
+		env_value = _get_env(name.upper(), dotenv)
+		if env_value is not None and env_value.strip() != "":
+			overrides[name] = env_value
+	values = {name: _coerce(name, known[name].type, value) for name, value in overrides.items()}
+	settings = replace(Settings(), **values)
+	settings.validate()
+	return settings
+
+
+_current = Settings()
+
+
+def get_settings() -> Settings:
+	"""Return the live settings. Read on every use so reloads take effect immediately."""
+	return _current
+
+
+def reload_settings() -> tuple[bool, str]:
+	"""Re-read .env, the settings file and the environment; apply only if valid."""
+	global _current
+	try:
+		new = load_settings()
+	except ValueError as e:
+		return False, f"Настройки не применены: {e}"
+	old = _current
+	_current = new
+	changes = [
+		f"{f.name}: {getattr(old, f.name)} → {getattr(new, f.name)}"
+		+ (" (вступит в силу после перезапуска)" if f.name in _RESTART_REQUIRED else "")
+		for f in fields(Settings)
+		if f.name != "admin_user_ids" and getattr(old, f.name) != getattr(new, f.name)
+	]
+	if not changes:
+		return True, "Настройки перечитаны, изменений нет."
+	return True, "Настройки обновлены:\n" + "\n".join(changes)
@@ -8,9 +8,11 @@ START_TEXT = (
 	"/system — задать системный промпт (след. сообщением)\n"
 	"/end — завершить сессию и освободить модель\n"
 	"/clearhistory — очистить историю диалога\n"
+	"/contextmode — вкл/выкл инкрементальный режим контекста\n"
 	"/settemp, /settopp, /setmax — интерактивно задают параметры\n"
 	"/pingollama — проверить доступность Ollama\n\n"
-	"После выбора модели пишите сообщения — они уйдут в модель."
+	"После выбора модели пишите сообщения — они уйдут в модель.\n"
+	"Текстовые документы (логи, .txt, .md и т.п.) обрабатываются по частям (подпись к файлу — задача)."
 )
 
 HELP_TEXT = (
@@ -20,6 +22,7 @@ HELP_TEXT = (
 	"/system — задать системный промпт (след. сообщением)\n"
 	"/end — завершить сессию\n"
 	"/clearhistory — очистить историю диалога\n"
+	"/contextmode — вкл/выкл инкрементальный режим контекста\n"
 	"/settemp, /settopp, /setmax — интерактивное задание значений\n"
 	"/pingollama — проверить Ollama\n"
 )
@@ -33,10 +36,32 @@ ERR_TEMP = "Некорректное значение для температу
 ERR_TOPP = "Некорректное значение для top_p (0.0..1.0)"
 ERR_MAX = "Некорректное значение для max_tokens (положительное целое)"
 
+PENDING_CANCELLED = "Ожидание ввода отменено."
+
 STATUS_SYSTEM_SET = "system_prompt: задан (скрыто)"
 STATUS_SYSTEM_NOT_SET = "system_prompt: не задан"
 
-INACTIVITY_ENDED = "Сессия завершена из-за бездействия (5 минут)."
+INACTIVITY_ENDED = "Сессия завершена из-за бездействия ({minutes} мин)."
+
+ADMIN_ONLY = "Команда доступна только администраторам бота."
+
+CONTEXT_MODE_ON = (
+	"Инкрементальный режим включён: модели отправляется только новое сообщение, "
+	"контекст хранится на стороне Ollama. При смене модели, промпта или настроек история будет переотправлена."
+)
+CONTEXT_MODE_OFF = "Инкрементальный режим выключен: история диалога отправляется целиком."
+
+DOC_STARTED = "📄 Документ получен, разбиваю на части..."
+DOC_PROGRESS = "📄 Обработано частей: {done} из {total}"
+DOC_FAILED = "Не удалось обработать документ: {error}\nОбработанные части сохранены — повторная отправка продолжит с того же места."
+DOC_DOWNLOAD_FAILED = "Не удалось скачать документ из Telegram. Попробуйте отправить его ещё раз."
+DOC_NOT_TEXT = "Поддерживаются только текстовые документы (логи, .txt, .md, .json, .csv и т.п.)."
+DOC_TOO_LARGE = "Документ слишком большой (максимум {mb} МБ)."
+
+INLINE_STILL_GENERATING = "⏳ Ответ ещё генерируется — повторите запрос через несколько секунд"
+INLINE_ERROR = "Ошибка запроса к модели"
+
+ROUTED_NOTE = "\n\n⚡ Ответ дала модель {model}: выбранная модель сейчас перегружена."
 
 NEED_SELECT_MODEL = "Сначала выберите модель через /omodels."
 
@@ -48,4 +73,7 @@ MODEL_BUSY = "⚠️ Модель '{model}' занята пользовател
 
 # Startup/shutdown notifications
 BOT_STARTED = "🚀 Бот запущен и готов к работе! Используйте /omodels для выбора модели."
-BOT_SHUTTING_DOWN = "🛑 Бот будет выключен через несколько секунд. Все сессии завершены."
+BOT_SHUTTING_DOWN = "🛑 Бот выключается. Настройки и история диалога сохранены и восстановятся после запуска; модель нужно будет выбрать заново."
+BOT_DRAINING = "🛑 Бот перезапускается и не принимает новые запросы. Повторите через минуту."
+REQUEST_INTERRUPTED = "⚠️ Запрос прерван перезапуском бота. Он сохранён — после запуска бот напомнит о нём."
+REQUEST_RESTORED = "🔁 Ваш запрос был прерван перезапуском бота. Отправьте его ещё раз:\n\n{text}"